@@ -0,0 +1,50 @@
+"""
+TP-Link Kasa smartplug protocol helpers shared by the plug_* scripts.
+
+Copied and modified from https://github.com/softScheck/tplink-smartplug
+"""
+
+from struct import pack
+from typing import Dict, Union
+
+try:
+  # orjson parses the smartplug responses several times faster, if installed.
+  from orjson import loads as json_loads
+except ImportError:
+  from json import loads as json_loads
+
+SMARTPLUG_PORT = 9999
+
+
+def encrypt(string: str) -> bytes:
+  """Encrypts a string into a length-prefixed smartplug protocol frame."""
+  plain = string.encode()
+  n = len(plain)
+  # Each cipher byte is the running XOR of the plaintext seeded with 171.
+  # Put the seed on top of the message as one big integer and compute the
+  # prefix XOR with log2(n) shift-XOR doubling steps over all bytes at once.
+  cipher = int.from_bytes(plain, 'big') | 171 << 8 * n
+  shift = 8
+  while shift <= 8 * n:
+    cipher ^= cipher >> shift
+    shift <<= 1
+  return pack('>I', n) + (cipher & ((1 << 8 * n) - 1)).to_bytes(n, 'big')
+
+
+def decrypt(string: Union[bytes, bytearray, memoryview]) -> bytes:
+  """Decrypts a smartplug protocol payload (without the length prefix)."""
+  # Each byte was XORed with the previous cipher byte (171 for the first),
+  # so XOR the whole message with itself shifted down one byte.
+  n = len(string)
+  cipher = int.from_bytes(string, 'big')
+  key = (cipher | 171 << 8 * n) >> 8
+  return (cipher ^ key).to_bytes(n, 'big')
+
+
+# https://github.com/softScheck/tplink-smartplug/blob/master/tplink-smarthome-commands.txt
+SYSINFO_FRAME = encrypt('{"system":{"get_sysinfo":null}}')
+
+STATE_FRAMES: Dict[int, bytes] = {
+    0: encrypt('{"system":{"set_relay_state":{"state":0}}}'),
+    1: encrypt('{"system":{"set_relay_state":{"state":1}}}'),
+}
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+import importlib
+import json
+import sys
+import unittest
+from unittest.mock import patch
+
+import kasa_proto
+
+class TestEncryption(unittest.TestCase):
+  def test_encrypt_decrypt(self):
+    original = '{"system":{"get_sysinfo":null}}'
+    encrypted = kasa_proto.encrypt(original)
+    decrypted = kasa_proto.decrypt(encrypted[4:])
+    self.assertEqual(original.encode(), decrypted)
+
+  def test_encrypt_known_frame(self):
+    encrypted = kasa_proto.encrypt('{"system":{"get_sysinfo":null}}')
+    self.assertEqual(
+        encrypted,
+        b'\x00\x00\x00\x1f\xd0\xf2\x81\xf8\x8b\xff\x9a\xf7\xd5\xef'
+        b'\x94\xb6\xd1\xb4\xc0\x9f\xec\x95\xe6\x8f\xe1\x87\xe8\xca'
+        b'\xf0\x9e\xeb\x87\xeb\x96\xeb')
+
+  def test_empty_string(self):
+    self.assertEqual(kasa_proto.encrypt(''), b'\x00\x00\x00\x00')
+    self.assertEqual(kasa_proto.decrypt(b''), b'')
+
+  def test_decrypt_memoryview(self):
+    encrypted = kasa_proto.encrypt('{"system":{"get_sysinfo":null}}')
+    self.assertEqual(
+        kasa_proto.decrypt(memoryview(encrypted)[4:]),
+        b'{"system":{"get_sysinfo":null}}')
+
+  def test_frames(self):
+    self.assertEqual(
+        kasa_proto.SYSINFO_FRAME,
+        kasa_proto.encrypt('{"system":{"get_sysinfo":null}}'))
+    for state in (0, 1):
+      self.assertEqual(
+          kasa_proto.decrypt(kasa_proto.STATE_FRAMES[state][4:]),
+          b'{"system":{"set_relay_state":{"state":%d}}}' % state)
+
+class TestJsonLoads(unittest.TestCase):
+  def test_loads_bytes(self):
+    self.assertEqual(
+        kasa_proto.json_loads(b'{"system":{"get_sysinfo":{"relay_state":1}}}'),
+        {'system': {'get_sysinfo': {'relay_state': 1}}})
+
+  def test_stdlib_fallback(self):
+    self.addCleanup(importlib.reload, kasa_proto)
+    with patch.dict(sys.modules, {'orjson': None}):
+      importlib.reload(kasa_proto)
+    self.assertIs(kasa_proto.json_loads, json.loads)
+    self.test_loads_bytes()
+
+if __name__ == '__main__':
+  unittest.main()
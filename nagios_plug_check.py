@@ -8,30 +8,12 @@ import socket
 import sys
 import time
 from datetime import datetime, timedelta
-from struct import pack
 
-def encrypt(string):
-  key = 171
-  result = pack('>I', len(string))
-  for i in string:
-    a = key ^ ord(i)
-    key = a
-    result += bytes([a])
-  return result
-
-
-def decrypt(string):
-  key = 171
-  result = ''
-  for i in string:
-    a = key ^ i
-    key = i
-    result += chr(a)
-  return result
+from kasa_proto import SMARTPLUG_PORT, SYSINFO_FRAME, decrypt
 
 
 def query_smartplug(sock):
-  sock.send(COMMANDS['sysinfo'])
+  sock.send(SYSINFO_FRAME)
   str_data = sock.recv(2048)
   decrypted = decrypt(str_data[4:])
   data = json.loads(decrypted)
@@ -46,13 +28,6 @@ def setup_socket(ip):
   return sock
 
 
-# https://github.com/softScheck/tplink-smartplug/blob/master/tplink-smarthome-commands.txt
-COMMANDS = {
-    'sysinfo': encrypt('{"system":{"get_sysinfo":null}}'),
-}
-
-SMARTPLUG_PORT = 9999
-
 STATES = ['off', 'on']
 
 parser = argparse.ArgumentParser()
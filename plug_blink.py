@@ -5,51 +5,33 @@ import argparse
 import json
 import logging
 import socket
-import struct
 import time
 import sys
 from typing import Dict, Any, Union
 
-# https://github.com/softScheck/tplink-smartplug/blob/master/tplink-smarthome-commands.txt
-COMMANDS = {
-  'sysinfo': '{"system":{"get_sysinfo":null}}',
-}
-
-SMARTPLUG_PORT = 9999
+import kasa_proto
 
 
 class SmartPlug:
-  def __init__(self, host: str, port: int = SMARTPLUG_PORT, timeout: int = 5):
+  def __init__(
+    self, host: str, port: int = kasa_proto.SMARTPLUG_PORT, timeout: int = 5,
+  ):
     self.host = host
     self.port = port
     self.timeout = timeout
 
-  @staticmethod
-  def encrypt(string: str) -> bytes:
-    key = 171
-    result = struct.pack('>I', len(string))
-    for char in string:
-      a = key ^ ord(char)
-      key = a
-      result += bytes([a])
-    return result
-
-  @staticmethod
-  def decrypt(string: bytes) -> str:
-    key = 171
-    result = ''
-    for char in string:
-      a = key ^ char
-      key = char
-      result += chr(a)
-    return result
-
-  def _send_command(self, command_str: str) -> str:
+  encrypt = staticmethod(kasa_proto.encrypt)
+  decrypt = staticmethod(kasa_proto.decrypt)
+
+  def _send_command(self, command: Union[str, bytes]) -> bytes:
+    # Accept either a JSON string or an already encrypted frame.
+    if isinstance(command, str):
+      command = self.encrypt(command)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
       sock.settimeout(self.timeout)
       try:
         sock.connect((self.host, self.port))
-        sock.send(self.encrypt(command_str))
+        sock.send(command)
         data = sock.recv(2048)
         return self.decrypt(data[4:])
       except socket.error as e:
@@ -57,13 +39,12 @@ class SmartPlug:
         raise
 
   def get_relay_state(self) -> int:
-    response = self._send_command(COMMANDS['sysinfo'])
+    response = self._send_command(kasa_proto.SYSINFO_FRAME)
     data = json.loads(response)
     return data['system']['get_sysinfo']['relay_state']
 
   def set_relay_state(self, state: int) -> None:
-    cmd = '{"system":{"set_relay_state":{"state":' + str(state) + '}}}'
-    self._send_command(cmd)
+    self._send_command(kasa_proto.STATE_FRAMES[state])
 
 
 def main() -> None:
@@ -90,13 +71,18 @@ def main() -> None:
 
     current_state = original_relay_state
     toggles = args.blinks
+    logging.info('Blinking %d times, %d ms apart.', toggles, args.delay)
 
+    # Sleep until absolute deadlines so the time spent talking to the plug
+    # doesn't add up and stretch the blink period.
+    deadline = time.monotonic()
     for i in range(toggles):
       current_state ^= 1
-      logging.info('Setting smartplug state to "%s" (Commit %d/%d).',
-                   'on' if current_state else 'off', i + 1, toggles)
+      logging.debug('Setting smartplug state to "%s" (Commit %d/%d).',
+                    'on' if current_state else 'off', i + 1, toggles)
       plug.set_relay_state(current_state)
-      time.sleep(args.delay / 1000)
+      deadline += args.delay / 1000
+      time.sleep(max(0, deadline - time.monotonic()))
 
     if current_state != original_relay_state:
       logging.info('Returning to original state "%s".',
@@ -104,7 +90,7 @@ def main() -> None:
       plug.set_relay_state(original_relay_state)
 
   except Exception as e:
-    logging.error(f'An error occurred: {e}')
+    logging.error('An error occurred: %s', e)
     sys.exit(1)
 
 
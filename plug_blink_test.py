@@ -5,6 +5,7 @@ import socket
 import json
 import struct
 
+import kasa_proto
 import plug_blink
 
 
@@ -18,13 +19,13 @@ class TestSmartPlug(unittest.TestCase):
     original = '{"system":{"get_sysinfo":null}}'
     encrypted = plug_blink.SmartPlug.encrypt(original)
     decrypted = plug_blink.SmartPlug.decrypt(encrypted[4:]) # Skip length header
-    self.assertEqual(original, decrypted)
+    self.assertEqual(original.encode(), decrypted)
 
   def test_init(self):
     """Test initialization defaults."""
     p = plug_blink.SmartPlug('1.2.3.4')
     self.assertEqual(p.host, '1.2.3.4')
-    self.assertEqual(p.port, plug_blink.SMARTPLUG_PORT)
+    self.assertEqual(p.port, kasa_proto.SMARTPLUG_PORT)
     self.assertEqual(p.timeout, 5)
 
   @patch('socket.socket')
@@ -39,19 +40,30 @@ class TestSmartPlug(unittest.TestCase):
 
     result = self.plug._send_command('test_command')
 
-    mock_sock.connect.assert_called_with((self.host, plug_blink.SMARTPLUG_PORT))
+    mock_sock.connect.assert_called_with((self.host, kasa_proto.SMARTPLUG_PORT))
     self.assertTrue(mock_sock.send.called)
-    self.assertEqual(result, response_data)
+    self.assertEqual(result, response_data.encode())
+
+  @patch('socket.socket')
+  def test_send_command_pre_encrypted(self, mock_socket_cls: MagicMock):
+    """Test that an encrypted frame is sent as-is."""
+    mock_sock = MagicMock()
+    mock_socket_cls.return_value.__enter__.return_value = mock_sock
+    mock_sock.recv.return_value = plug_blink.SmartPlug.encrypt('{}')
+
+    frame = plug_blink.SmartPlug.encrypt('test_command')
+    self.plug._send_command(frame)
+    mock_sock.send.assert_called_with(frame)
 
   @patch('plug_blink.SmartPlug._send_command')
   def test_get_relay_state(self, mock_send: MagicMock):
     """Test parsing the relay state."""
-    mock_send.return_value = '{"system":{"get_sysinfo":{"relay_state":1}}}'
+    mock_send.return_value = b'{"system":{"get_sysinfo":{"relay_state":1}}}'
     state = self.plug.get_relay_state()
     self.assertEqual(state, 1)
-    mock_send.assert_called_with(plug_blink.COMMANDS['sysinfo'])
+    mock_send.assert_called_with(kasa_proto.SYSINFO_FRAME)
 
-    mock_send.return_value = '{"system":{"get_sysinfo":{"relay_state":0}}}'
+    mock_send.return_value = b'{"system":{"get_sysinfo":{"relay_state":0}}}'
     state = self.plug.get_relay_state()
     self.assertEqual(state, 0)
 
@@ -60,11 +72,11 @@ class TestSmartPlug(unittest.TestCase):
     """Test setting the relay state."""
     self.plug.set_relay_state(1)
     expected_cmd = '{"system":{"set_relay_state":{"state":1}}}'
-    mock_send.assert_called_with(expected_cmd)
+    mock_send.assert_called_with(plug_blink.SmartPlug.encrypt(expected_cmd))
 
     self.plug.set_relay_state(0)
     expected_cmd_0 = '{"system":{"set_relay_state":{"state":0}}}'
-    mock_send.assert_called_with(expected_cmd_0)
+    mock_send.assert_called_with(plug_blink.SmartPlug.encrypt(expected_cmd_0))
 
   @patch('logging.error')
   @patch('socket.socket')
@@ -80,5 +92,29 @@ class TestSmartPlug(unittest.TestCase):
       self.plug._send_command('foo')
 
 
+class TestMain(unittest.TestCase):
+  @patch('time.sleep')
+  @patch('time.monotonic')
+  @patch('plug_blink.SmartPlug')
+  def test_blink_period_absorbs_command_time(
+    self, mock_plug_cls: MagicMock, mock_monotonic: MagicMock,
+    mock_sleep: MagicMock,
+  ):
+    """Test that sleeps are shortened by the time spent sending commands."""
+    mock_plug = mock_plug_cls.return_value
+    mock_plug.get_relay_state.return_value = 0
+    # Start of the loop, then after each of the two commands (50ms, 300ms).
+    mock_monotonic.side_effect = [10.0, 10.05, 10.5]
+
+    argv = ['plug_blink.py', '-s', '1.2.3.4', '--blinks', '2', '--delay', '200']
+    with patch('sys.argv', argv):
+      plug_blink.main()
+
+    self.assertEqual(mock_sleep.call_count, 2)
+    self.assertAlmostEqual(mock_sleep.call_args_list[0].args[0], 0.15)
+    self.assertEqual(mock_sleep.call_args_list[1].args[0], 0)
+    mock_plug.set_relay_state.assert_has_calls([call(1), call(0)])
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -8,30 +8,12 @@ import socket
 import sys
 import time
 from datetime import datetime, timedelta
-from struct import pack
 
-def encrypt(string):
-  key = 171
-  result = pack('>I', len(string))
-  for i in string:
-    a = key ^ ord(i)
-    key = a
-    result += bytes([a])
-  return result
-
-
-def decrypt(string):
-  key = 171
-  result = ''
-  for i in string:
-    a = key ^ i
-    key = i
-    result += chr(a)
-  return result
+from kasa_proto import SMARTPLUG_PORT, STATE_FRAMES, SYSINFO_FRAME, decrypt
 
 
 def query_smartplug(sock):
-  sock.send(COMMANDS['sysinfo'])
+  sock.send(SYSINFO_FRAME)
   str_data = sock.recv(2048)
   decrypted = decrypt(str_data[4:])
   data = json.loads(decrypted)
@@ -47,21 +29,9 @@ def setup_socket(ip):
 
 
 def set_state(sock, desired_state):
-  logging.info('Setting smartplug state to "%s".', STATES[desired_state])
-  sock.send(COMMANDS['state'][desired_state])
-  logging.info('Done.')
-
-
-# https://github.com/softScheck/tplink-smartplug/blob/master/tplink-smarthome-commands.txt
-COMMANDS = {
-    'state': {
-      0: encrypt('{"system":{"set_relay_state":{"state":0}}}'),
-      1: encrypt('{"system":{"set_relay_state":{"state":1}}}'),
-    },
-    'sysinfo': encrypt('{"system":{"get_sysinfo":null}}'),
-}
+  sock.send(STATE_FRAMES[desired_state])
+  logging.info('Set smartplug state to "%s".', STATES[desired_state])
 
-SMARTPLUG_PORT = 9999
 
 STATES = ['off', 'on']
 
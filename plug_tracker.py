@@ -9,17 +9,32 @@ Copied and modified from https://github.com/softScheck/tplink-smartplug
 """
 
 import argparse
-import json
+import importlib.util
 import logging
+import os
+import re
+import selectors
 import socket
 import sys
 import time
-from datetime import datetime, timedelta, date, time as dt_time
-from struct import pack
+from bisect import bisect_right
+from datetime import datetime, date, time as dt_time
+from struct import unpack_from
 from typing import List, Tuple, Optional, Dict, Any
 
+from kasa_proto import (
+    SMARTPLUG_PORT, STATE_FRAMES, SYSINFO_FRAME, decrypt, json_loads)
+
+# Largest response accepted from a plug; real sysinfo replies are about 1 KiB.
+# A larger length header is treated as a broken connection, not buffered.
+MAX_RESPONSE_SIZE = 64 * 1024
+
+MYPYLIB_PATH = '/opt/repos/mypylib'
+
 # Adjust path to find mypylib if needed
-sys.path.append('/opt/repos/mypylib')
+if (importlib.util.find_spec('mypylib') is None
+    and os.path.isdir(MYPYLIB_PATH)):
+  sys.path.append(MYPYLIB_PATH)
 try:
   from mypylib import setup_logging
 except ImportError:
@@ -32,71 +47,113 @@ except ImportError:
     )
 
 
-def encrypt(string: str) -> bytes:
-  """Encrypts a string for TP-Link smartplug protocol."""
-  key = 171
-  result = pack('>I', len(string))
-  for i in string:
-    a = key ^ ord(i)
-    key = a
-    result += bytes([a])
-  return result
-
-
-def decrypt(string: bytes) -> str:
-  """Decrypts a byte string from TP-Link smartplug protocol."""
-  key = 171
-  result = ''
-  for i in string:
-    a = key ^ i
-    key = i
-    result += chr(a)
-  return result
-
-
-COMMANDS = {
-    'state': {
-        0: encrypt('{"system":{"set_relay_state":{"state":0}}}'),
-        1: encrypt('{"system":{"set_relay_state":{"state":1}}}'),
-    },
-    'sysinfo': encrypt('{"system":{"get_sysinfo":null}}'),
-}
-
-SMARTPLUG_PORT = 9999
-
-
 class SmartPlugClient:
-  """Client for interacting with a TP-Link smartplug."""
+  """Client for interacting with a TP-Link smartplug.
+
+  A single TCP connection is kept open and reused across commands; if a
+  command fails on a reused connection, it is retried once on a new one.
+  """
 
   def __init__(self, ip: str):
     self.ip = ip
+    self._sock: Optional[socket.socket] = None
+    # Responses are read into this buffer, which grows if one doesn't fit
+    # (up to MAX_RESPONSE_SIZE).
+    self._rxbuf = bytearray(4096)
 
   def _connect(self) -> socket.socket:
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(2.0)
+    # Commands are small writes on a long-lived connection; don't let Nagle
+    # hold them back waiting for the ACK of the previous exchange.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     sock.connect((self.ip, SMARTPLUG_PORT))
     return sock
 
+  @property
+  def sock(self) -> Optional[socket.socket]:
+    """The open connection to the smartplug, if any."""
+    return self._sock
+
+  def _ensure_connected(self) -> socket.socket:
+    if self._sock is None:
+      self._sock = self._connect()
+    return self._sock
+
+  def close(self) -> None:
+    """Closes the connection to the smartplug, if open."""
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+
+  @staticmethod
+  def _recv_exactly(sock: socket.socket, view: memoryview) -> None:
+    while view:
+      received = sock.recv_into(view)
+      if not received:
+        raise ConnectionResetError('Connection closed by smartplug')
+      view = view[received:]
+
+  def _exchange(self, frame: bytes) -> memoryview:
+    sock = self._ensure_connected()
+    try:
+      sock.sendall(frame)
+      self._recv_exactly(sock, memoryview(self._rxbuf)[:4])
+      length = unpack_from('>I', self._rxbuf)[0]
+      if length > MAX_RESPONSE_SIZE:
+        raise ConnectionResetError(
+            f'Response length {length} exceeds {MAX_RESPONSE_SIZE} bytes')
+      if length + 4 > len(self._rxbuf):
+        self._rxbuf = bytearray(length + 4)
+      body = memoryview(self._rxbuf)[4:4 + length]
+      self._recv_exactly(sock, body)
+      return body
+    except OSError:
+      # The connection is in an unknown state; start over next time.
+      self.close()
+      raise
+
+  def _request(self, frame: bytes) -> memoryview:
+    """Sends an encrypted frame and returns the encrypted response body.
+
+    The result is a view into the receive buffer and is only valid until the
+    next request.
+    """
+    reused = self._sock is not None
+    try:
+      return self._exchange(frame)
+    except OSError:
+      if not reused:
+        raise
+      # A connection that sat idle may have been dropped by the plug, with a
+      # reset or silently (reboot, Wi-Fi roam), so retry once on a fresh one.
+      return self._exchange(frame)
+
   def get_relay_state(self) -> int:
     """Queries the smartplug for its relay state (0 or 1)."""
-    sock = self._connect()
-    try:
-      sock.send(COMMANDS['sysinfo'])
-      # Receive header to know length, or just read a chunk
-      data = sock.recv(2048)
-      decrypted = decrypt(data[4:])
-      json_data = json.loads(decrypted)
-      return json_data['system']['get_sysinfo']['relay_state']
-    finally:
-      sock.close()
+    decrypted = decrypt(self._request(SYSINFO_FRAME))
+    json_data = json_loads(decrypted)
+    return json_data['system']['get_sysinfo']['relay_state']
 
   def set_relay_state(self, state: int) -> None:
     """Sets the smartplug relay state."""
-    sock = self._connect()
-    try:
-      sock.send(COMMANDS['state'][state])
-    finally:
-      sock.close()
+    # The response must be consumed so it is not mistaken for the reply to
+    # the next command on this connection.
+    self._request(STATE_FRAMES[state])
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Maximum time between evaluations of the schedule, so wall-clock steps
+# (NTP, DST) take effect promptly.
+SCHEDULE_CHECK_SECONDS = 60
+
+# Minimum time between retries of a failed follower update.
+FOLLOWER_RETRY_SECONDS = 30
+
+
+def _seconds_since_midnight(t: dt_time) -> float:
+  return t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1e6
 
 
 class Scheduler:
@@ -108,50 +165,70 @@ class Scheduler:
     # If no windows provided, we are always active
     self.always_active = len(active_windows) == 0
 
+    # Split windows that cross midnight in two and merge overlapping ones,
+    # leaving disjoint spans (in seconds since midnight) sorted by start so
+    # lookups are a binary search.
+    spans = []
+    for start, end in active_windows:
+      start_s = _seconds_since_midnight(start)
+      end_s = _seconds_since_midnight(end)
+      if start_s <= end_s:
+        spans.append((start_s, end_s))
+      else:
+        spans.append((0, end_s))
+        spans.append((start_s, SECONDS_PER_DAY))
+    spans.sort()
+    self._span_starts: List[float] = []
+    self._span_ends: List[float] = []
+    for start_s, end_s in spans:
+      if self._span_ends and start_s <= self._span_ends[-1]:
+        self._span_ends[-1] = max(self._span_ends[-1], end_s)
+      else:
+        self._span_starts.append(start_s)
+        self._span_ends.append(end_s)
+    self._window_starts = sorted(
+        _seconds_since_midnight(start) for start, _ in active_windows)
+
   def is_active(self, current_time: dt_time) -> bool:
     """Checks if the current time is within any active window."""
     if self.always_active:
       return True
 
-    for start, end in self.active_windows:
-      if start <= end:
-        if start <= current_time <= end:
-          return True
-      else:  # Window crosses midnight
-        if current_time >= start or current_time <= end:
-          return True
-    return False
+    current_s = _seconds_since_midnight(current_time)
+    i = bisect_right(self._span_starts, current_s) - 1
+    return i >= 0 and current_s <= self._span_ends[i]
 
   def seconds_until_next_active(self, current_dt: datetime) -> int:
     """Calculates seconds until the next active window starts."""
     if self.always_active:
       return 0
 
-    current_time = current_dt.time()
-    min_wait_seconds = float('inf')
+    current_s = _seconds_since_midnight(current_dt.time())
+    i = bisect_right(self._window_starts, current_s)
+    if i < len(self._window_starts):
+      next_start = self._window_starts[i]
+    else:
+      # Start time is tomorrow
+      next_start = self._window_starts[0] + SECONDS_PER_DAY
+    return int(next_start - current_s)
 
-    found_window = False
+  def seconds_until_window_end(self, current_dt: datetime) -> float:
+    """Calculates seconds until the active window containing now ends.
 
-    for start, _ in self.active_windows:
-      # If start time is later today
-      if start > current_time:
-        next_start = datetime.combine(current_dt.date(), start)
-      else:
-        # Start time is tomorrow
-        next_start = datetime.combine(
-            current_dt.date() + timedelta(days=1), start)
-      
-      wait = (next_start - current_dt).total_seconds()
-      if wait < min_wait_seconds:
-        min_wait_seconds = wait
-        found_window = True
-    
-    # Also handle case where we might be *in* a window? 
-    # The caller typically calls this only when !is_active().
-    # But if calling blindly, we should check if we are already active?
-    # Spec says: "not be running" if not active.
-
-    return int(min_wait_seconds) if found_window else 0
+    Returns 0 if not currently active and infinity if always active.
+    """
+    if self.always_active:
+      return float('inf')
+
+    current_s = _seconds_since_midnight(current_dt.time())
+    i = bisect_right(self._span_starts, current_s) - 1
+    if i < 0 or current_s > self._span_ends[i]:
+      return 0.0
+    end_s = self._span_ends[i]
+    if end_s == SECONDS_PER_DAY and self._span_starts[0] == 0:
+      # Window crosses midnight, so it continues into tomorrow's first span.
+      end_s += self._span_ends[0]
+    return end_s - current_s
 
 
 class PlugTracker:
@@ -162,28 +239,56 @@ class PlugTracker:
     self.follower_client = SmartPlugClient(follower_ip)
     self.scheduler = scheduler
     self.prev_state = -1
+    # Last state set on the follower, or None if unknown.
+    self.follower_state: Optional[int] = None
+    # Monotonic time before which a failed follower update isn't retried.
+    self._follower_retry_at = 0.0
+    self._follower_failing = False
+    # Watches the leader connection while waiting between ticks.
+    self._selector = selectors.DefaultSelector()
+    self._watched_sock: Optional[socket.socket] = None
+
+  def close(self) -> None:
+    """Closes the plug connections and the selector."""
+    self.leader_client.close()
+    self.follower_client.close()
+    self._selector.close()
+    self._watched_sock = None
 
   def run(self) -> None:
     """Main loop."""
     logging.info('PlugTracker started.')
     is_sleeping = False
-    
+    # Monotonic time at which the schedule has to be evaluated again. Until
+    # then the loop only ticks, without consulting the wall clock.
+    schedule_deadline = 0.0
+
     while True:
-      now = datetime.now()
-      
-      if not self.scheduler.is_active(now.time()):
-        wait_seconds = self.scheduler.seconds_until_next_active(now)
-        if not is_sleeping:
-          logging.info(
-              'Outside active hours. Sleeping for %d seconds.', wait_seconds)
-          is_sleeping = True
-          self.prev_state = -1  # Reset state on sleep
-        time.sleep(wait_seconds)
-        continue
-
-      if is_sleeping:
-        logging.info('Waking up. Resuming operations.')
-        is_sleeping = False
+      if time.monotonic() >= schedule_deadline:
+        now = datetime.now()
+
+        if not self.scheduler.is_active(now.time()):
+          wait_seconds = self.scheduler.seconds_until_next_active(now)
+          if not is_sleeping:
+            logging.info(
+                'Outside active hours. Sleeping for %d seconds.', wait_seconds)
+            is_sleeping = True
+            self.prev_state = -1  # Reset state on sleep
+            self.leader_client.close()
+            self.follower_client.close()
+          # Wake up periodically in case the wall clock is stepped meanwhile.
+          time.sleep(min(wait_seconds, SCHEDULE_CHECK_SECONDS))
+          continue
+
+        if is_sleeping:
+          logging.info('Waking up. Resuming operations.')
+          is_sleeping = False
+
+        # Don't trust the window end computed here for longer than
+        # SCHEDULE_CHECK_SECONDS, in case the wall clock is stepped.
+        schedule_deadline = time.monotonic() + min(
+            self.scheduler.seconds_until_window_end(now),
+            SCHEDULE_CHECK_SECONDS)
 
       try:
         self.tick()
@@ -192,7 +297,32 @@ class PlugTracker:
         # Sleep a bit to avoid rapid looping on error
         time.sleep(5)
 
-      time.sleep(1)
+      remaining = schedule_deadline - time.monotonic()
+      self._wait(max(0.0, min(1.0, remaining)))
+
+  def _wait(self, timeout: float) -> None:
+    """Waits between ticks, dropping the leader link if the plug closes it."""
+    deadline = time.monotonic() + timeout
+    sock = self.leader_client.sock
+    if sock is not self._watched_sock:
+      if self._watched_sock is not None:
+        self._selector.unregister(self._watched_sock)
+      if sock is not None:
+        self._selector.register(sock, selectors.EVENT_READ)
+      self._watched_sock = sock
+    if sock is None:
+      time.sleep(timeout)
+      return
+
+    if self._selector.select(timeout):
+      # The plug never sends unsolicited data, so an idle connection only
+      # becomes readable when it is closed. Drop it, but keep waiting so a
+      # plug that hangs up after every reply can't speed up the polling;
+      # the next tick reconnects.
+      self._selector.unregister(sock)
+      self._watched_sock = None
+      self.leader_client.close()
+      time.sleep(max(0.0, deadline - time.monotonic()))
 
   def tick(self) -> None:
     """Single iteration of checking and updating."""
@@ -202,27 +332,57 @@ class PlugTracker:
       logging.warning('Could not connect to leader: %s', e)
       return
 
-    if leader_state != self.prev_state:
-      if self.prev_state != -1:
-        logging.info(
-            'Leader changed to %d. Updating follower.', leader_state)
-        try:
-          self.follower_client.set_relay_state(leader_state)
-        except (socket.error, socket.timeout) as e:
-          logging.error('Failed to update follower: %s', e)
-      self.prev_state = leader_state
+    leader_changed = self.prev_state != -1 and leader_state != self.prev_state
+    if self.prev_state == -1:
+      # Initial sync is skipped: leave the follower alone until the leader
+      # changes, as if it already matched. Failures from before a sleep are
+      # forgotten too.
+      self.follower_state = leader_state
+      self._follower_retry_at = 0.0
+      self._follower_failing = False
+    elif leader_changed:
+      logging.info('Leader changed to %d. Updating follower.', leader_state)
+    self.prev_state = leader_state
+
+    # Only talk to the follower when it is not known to match. A failed
+    # update leaves its state unknown, so it is retried, but at most every
+    # FOLLOWER_RETRY_SECONDS unless the leader changes again.
+    if leader_state == self.follower_state:
+      return
+    if not leader_changed and time.monotonic() < self._follower_retry_at:
+      return
+    try:
+      self.follower_client.set_relay_state(leader_state)
+    except (socket.error, socket.timeout) as e:
+      # Only report the first failure, not every retry.
+      if not self._follower_failing:
+        logging.error('Failed to update follower: %s', e)
+        self._follower_failing = True
+      self.follower_state = None
+      self._follower_retry_at = time.monotonic() + FOLLOWER_RETRY_SECONDS
+      return
+    if self._follower_failing:
+      logging.info('Follower updated to %d after earlier failures.',
+                   leader_state)
+      self._follower_failing = False
+    self.follower_state = leader_state
+
+
+_TIME_RANGE_RE = re.compile(
+    r'^\s*(\d{1,2}):(\d{1,2})\s*-\s*(\d{1,2}):(\d{1,2})\s*$')
 
 
 def parse_time_range(arg: str) -> Tuple[dt_time, dt_time]:
   """Parses a time range string like '08:00-10:00'."""
-  try:
-    start_str, end_str = arg.split('-')
-    start_time = datetime.strptime(start_str.strip(), '%H:%M').time()
-    end_time = datetime.strptime(end_str.strip(), '%H:%M').time()
-    return start_time, end_time
-  except ValueError:
-    raise argparse.ArgumentTypeError(
-        f"Invalid time range: '{arg}'. Format must be HH:MM-HH:MM")
+  match = _TIME_RANGE_RE.match(arg)
+  if match:
+    start_h, start_m, end_h, end_m = map(int, match.groups())
+    try:
+      return dt_time(start_h, start_m), dt_time(end_h, end_m)
+    except ValueError:  # Hour or minute out of range
+      pass
+  raise argparse.ArgumentTypeError(
+      f"Invalid time range: '{arg}'. Format must be HH:MM-HH:MM")
 
 
 def main() -> None:
@@ -254,6 +414,8 @@ def main() -> None:
     tracker.run()
   except KeyboardInterrupt:
     logging.info('Stopping PlugTracker.')
+  finally:
+    tracker.close()
 
 
 if __name__ == '__main__':
@@ -1,16 +1,125 @@
 #!/usr/bin/python3
+import argparse
+import socket
 import unittest
-from datetime import datetime, time, timedelta
+from datetime import datetime, time
 from unittest.mock import MagicMock, patch, call
 
+import kasa_proto
 import plug_tracker
 
-class TestEncryption(unittest.TestCase):
-  def test_encrypt_decrypt(self):
-    original = '{"system":{"get_sysinfo":null}}'
-    encrypted = plug_tracker.encrypt(original)
-    decrypted = plug_tracker.decrypt(encrypted[4:])
-    self.assertEqual(original, decrypted)
+def fake_recv_into(*responses):
+  """Returns a recv_into side effect serving the frames in small chunks."""
+  buf = bytearray(b''.join(responses))
+  def recv_into(view):
+    chunk = buf[:min(len(view), 7)]
+    view[:len(chunk)] = chunk
+    del buf[:len(chunk)]
+    return len(chunk)
+  return recv_into
+
+class TestSmartPlugClient(unittest.TestCase):
+  SYSINFO = '{"system":{"get_sysinfo":{"relay_state":1}}}'
+  SET_OK = '{"system":{"set_relay_state":{"err_code":0}}}'
+
+  @patch('socket.socket')
+  def test_connection_reused(self, mock_socket_cls):
+    mock_sock = mock_socket_cls.return_value
+    mock_sock.recv_into.side_effect = fake_recv_into(
+        kasa_proto.encrypt(self.SYSINFO), kasa_proto.encrypt(self.SET_OK))
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    self.assertEqual(client.get_relay_state(), 1)
+    client.set_relay_state(0)
+
+    mock_socket_cls.assert_called_once()
+    mock_sock.setsockopt.assert_called_once_with(
+        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    mock_sock.connect.assert_called_once_with(
+        ('1.1.1.1', kasa_proto.SMARTPLUG_PORT))
+    mock_sock.sendall.assert_has_calls([
+        call(kasa_proto.SYSINFO_FRAME),
+        call(kasa_proto.STATE_FRAMES[0]),
+    ])
+
+  @patch('socket.socket')
+  def test_reconnect_when_dropped(self, mock_socket_cls):
+    # Serves one reply, then the plug closes the idle connection (EOF).
+    stale_sock = MagicMock()
+    stale_sock.recv_into.side_effect = fake_recv_into(
+        kasa_proto.encrypt(self.SYSINFO))
+    fresh_sock = MagicMock()
+    fresh_sock.recv_into.side_effect = fake_recv_into(
+        kasa_proto.encrypt(self.SYSINFO))
+    mock_socket_cls.side_effect = [stale_sock, fresh_sock]
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    self.assertEqual(client.get_relay_state(), 1)
+    self.assertEqual(client.get_relay_state(), 1)
+    stale_sock.close.assert_called_once()
+    fresh_sock.sendall.assert_called_once_with(kasa_proto.SYSINFO_FRAME)
+
+  @patch('socket.socket')
+  def test_no_retry_on_fresh_connection(self, mock_socket_cls):
+    mock_sock = mock_socket_cls.return_value
+    mock_sock.recv_into.return_value = 0
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    with self.assertRaises(ConnectionResetError):
+      client.get_relay_state()
+    mock_socket_cls.assert_called_once()
+
+  @patch('socket.socket')
+  def test_timeout_closes_connection(self, mock_socket_cls):
+    mock_sock = mock_socket_cls.return_value
+    mock_sock.recv_into.side_effect = TimeoutError()
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    with self.assertRaises(TimeoutError):
+      client.get_relay_state()
+    mock_sock.close.assert_called_once()
+
+  @patch('socket.socket')
+  def test_reconnect_after_timeout_on_reused_connection(self, mock_socket_cls):
+    reused_sock = MagicMock()
+    reused_sock.recv_into.side_effect = fake_recv_into(
+        kasa_proto.encrypt(self.SET_OK))
+    fresh_sock = MagicMock()
+    fresh_sock.recv_into.side_effect = fake_recv_into(
+        kasa_proto.encrypt(self.SET_OK))
+    mock_socket_cls.side_effect = [reused_sock, fresh_sock]
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    client.set_relay_state(1)
+    # The idle connection was dropped silently, so the next command times
+    # out on it and is retried on a new connection.
+    reused_sock.recv_into.side_effect = TimeoutError()
+    client.set_relay_state(0)
+
+    reused_sock.close.assert_called_once()
+    fresh_sock.sendall.assert_called_once_with(kasa_proto.STATE_FRAMES[0])
+
+  @patch('socket.socket')
+  def test_large_response(self, mock_socket_cls):
+    sysinfo = ('{"system":{"get_sysinfo":{"alias":"%s","relay_state":1}}}'
+               % ('x' * 5000))
+    mock_sock = mock_socket_cls.return_value
+    mock_sock.recv_into.side_effect = fake_recv_into(
+        kasa_proto.encrypt(sysinfo))
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    self.assertEqual(client.get_relay_state(), 1)
+
+  @patch('socket.socket')
+  def test_oversized_response_rejected(self, mock_socket_cls):
+    mock_sock = mock_socket_cls.return_value
+    mock_sock.recv_into.side_effect = fake_recv_into(b'\xff\xff\xff\xff')
+
+    client = plug_tracker.SmartPlugClient('1.1.1.1')
+    with self.assertRaises(ConnectionResetError):
+      client.get_relay_state()
+    mock_sock.close.assert_called_once()
+    self.assertEqual(len(client._rxbuf), 4096)
 
 class TestScheduler(unittest.TestCase):
   def test_always_active_if_no_schedule(self):
@@ -38,6 +147,27 @@ class TestScheduler(unittest.TestCase):
     self.assertTrue(scheduler.is_active(time(21, 0)))
     self.assertFalse(scheduler.is_active(time(12, 0)))
 
+  def test_window_crossing_midnight(self):
+    # 22:00 to 02:00
+    schedule = [(time(22, 0), time(2, 0))]
+    scheduler = plug_tracker.Scheduler(schedule)
+    self.assertTrue(scheduler.is_active(time(22, 0)))
+    self.assertTrue(scheduler.is_active(time(23, 59, 59)))
+    self.assertTrue(scheduler.is_active(time(0, 0)))
+    self.assertTrue(scheduler.is_active(time(2, 0)))
+    self.assertFalse(scheduler.is_active(time(2, 1)))
+    self.assertFalse(scheduler.is_active(time(21, 59)))
+
+  def test_overlapping_windows(self):
+    # 08:00-12:00 contains 09:00-10:00
+    schedule = [
+        (time(8, 0), time(12, 0)),
+        (time(9, 0), time(10, 0))
+    ]
+    scheduler = plug_tracker.Scheduler(schedule)
+    self.assertTrue(scheduler.is_active(time(11, 0)))
+    self.assertFalse(scheduler.is_active(time(12, 1)))
+
   def test_seconds_until_next_active(self):
     # 08:00-10:00
     schedule = [(time(8, 0), time(10, 0))]
@@ -66,6 +196,36 @@ class TestScheduler(unittest.TestCase):
     wait = scheduler.seconds_until_next_active(current)
     self.assertEqual(wait, 28800)
 
+  def test_seconds_until_window_end(self):
+    # 08:00-10:00, 22:00-02:00
+    schedule = [
+        (time(8, 0), time(10, 0)),
+        (time(22, 0), time(2, 0))
+    ]
+    scheduler = plug_tracker.Scheduler(schedule)
+
+    # 09:00 -> window ends at 10:00 (1 hr)
+    current = datetime(2023, 1, 1, 9, 0, 0)
+    self.assertEqual(scheduler.seconds_until_window_end(current), 3600)
+
+    # 23:00 -> window ends at 02:00 tomorrow (3 hrs)
+    current = datetime(2023, 1, 1, 23, 0, 0)
+    self.assertEqual(scheduler.seconds_until_window_end(current), 10800)
+
+    # 01:00 -> window ends at 02:00 (1 hr)
+    current = datetime(2023, 1, 1, 1, 0, 0)
+    self.assertEqual(scheduler.seconds_until_window_end(current), 3600)
+
+    # 12:00 -> not active
+    current = datetime(2023, 1, 1, 12, 0, 0)
+    self.assertEqual(scheduler.seconds_until_window_end(current), 0)
+
+  def test_seconds_until_window_end_always_active(self):
+    scheduler = plug_tracker.Scheduler([])
+    current = datetime(2023, 1, 1, 12, 0, 0)
+    self.assertEqual(
+        scheduler.seconds_until_window_end(current), float('inf'))
+
 class TestPlugTracker(unittest.TestCase):
   @patch('plug_tracker.setup_logging')
   @patch('plug_tracker.SmartPlugClient')
@@ -84,6 +244,7 @@ class TestPlugTracker(unittest.TestCase):
         follower_ip='2.2.2.2',
         scheduler=mock_scheduler
     )
+    self.addCleanup(tracker.close)
     
     # Scenario 1: Leader state 0 (default prev_state -1) -> Follower NOT updated
     # (initial sync skipped)
@@ -101,6 +262,195 @@ class TestPlugTracker(unittest.TestCase):
     mock_leader.get_relay_state.return_value = 1
     tracker.tick()
     mock_follower.set_relay_state.assert_called_with(1)
+    self.assertEqual(tracker.follower_state, 1)
+
+  @patch('plug_tracker.time.monotonic')
+  @patch('plug_tracker.SmartPlugClient')
+  def test_tick_retries_failed_follower_update(
+      self, mock_client_cls, mock_monotonic):
+    mock_leader = MagicMock()
+    mock_follower = MagicMock()
+    mock_client_cls.side_effect = [mock_leader, mock_follower]
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', MagicMock())
+    self.addCleanup(tracker.close)
+    mock_monotonic.return_value = 100.0
+
+    mock_leader.get_relay_state.return_value = 0
+    tracker.tick()
+
+    # Leader changes to 1 but the follower update fails.
+    mock_leader.get_relay_state.return_value = 1
+    mock_follower.set_relay_state.side_effect = TimeoutError()
+    tracker.tick()
+    self.assertIsNone(tracker.follower_state)
+
+    # Leader unchanged and still within the backoff: no retry yet.
+    mock_follower.set_relay_state.side_effect = None
+    mock_follower.reset_mock()
+    tracker.tick()
+    mock_follower.set_relay_state.assert_not_called()
+
+    # Backoff elapsed: the update is retried and succeeds.
+    mock_monotonic.return_value += plug_tracker.FOLLOWER_RETRY_SECONDS
+    tracker.tick()
+    mock_follower.set_relay_state.assert_called_once_with(1)
+
+    # Follower is known to match: no further updates.
+    mock_follower.reset_mock()
+    tracker.tick()
+    mock_follower.set_relay_state.assert_not_called()
+
+  @patch('logging.error')
+  @patch('plug_tracker.time.monotonic')
+  @patch('plug_tracker.SmartPlugClient')
+  def test_tick_unreachable_follower_logs_once(
+      self, mock_client_cls, mock_monotonic, mock_log_error):
+    mock_leader = MagicMock()
+    mock_follower = MagicMock()
+    mock_client_cls.side_effect = [mock_leader, mock_follower]
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', MagicMock())
+    self.addCleanup(tracker.close)
+    mock_monotonic.return_value = 100.0
+    mock_follower.set_relay_state.side_effect = TimeoutError()
+
+    mock_leader.get_relay_state.return_value = 0
+    tracker.tick()
+    mock_leader.get_relay_state.return_value = 1
+
+    # Two minutes of one-second ticks with the follower offline.
+    for _ in range(120):
+      tracker.tick()
+      mock_monotonic.return_value += 1
+
+    mock_log_error.assert_called_once()
+    # Tried on the leader change, then retried after 30, 60 and 90 seconds.
+    self.assertEqual(mock_follower.set_relay_state.call_count, 4)
+
+  @patch('logging.error')
+  @patch('plug_tracker.time.monotonic')
+  @patch('plug_tracker.SmartPlugClient')
+  def test_tick_follower_failure_logged_again_after_wake(
+      self, mock_client_cls, mock_monotonic, mock_log_error):
+    mock_leader = MagicMock()
+    mock_follower = MagicMock()
+    mock_client_cls.side_effect = [mock_leader, mock_follower]
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', MagicMock())
+    self.addCleanup(tracker.close)
+    mock_monotonic.return_value = 100.0
+    mock_follower.set_relay_state.side_effect = TimeoutError()
+
+    # Evening: the follower update fails.
+    mock_leader.get_relay_state.return_value = 0
+    tracker.tick()
+    mock_leader.get_relay_state.return_value = 1
+    tracker.tick()
+    self.assertEqual(mock_log_error.call_count, 1)
+
+    # Sleep through the night (as run() does), then wake in the morning.
+    tracker.prev_state = -1
+    mock_monotonic.return_value += 10
+    tracker.tick()
+    self.assertFalse(tracker._follower_failing)
+
+    # Morning: the leader changes and the follower fails again.
+    mock_leader.get_relay_state.return_value = 0
+    tracker.tick()
+    self.assertEqual(mock_log_error.call_count, 2)
+
+  @patch('plug_tracker.time.sleep')
+  @patch('plug_tracker.datetime')
+  @patch('plug_tracker.SmartPlugClient')
+  def test_run_ticks_without_rereading_wall_clock(
+      self, mock_client_cls, mock_datetime, mock_sleep):
+    mock_client_cls.return_value.sock = None
+    mock_datetime.now.return_value = datetime(2023, 1, 1, 9, 0, 0)
+    # Three ticks, then stop the loop.
+    mock_sleep.side_effect = [None, None, KeyboardInterrupt]
+    scheduler = plug_tracker.Scheduler([(time(8, 0), time(10, 0))])
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', scheduler)
+    self.addCleanup(tracker.close)
+    tracker.tick = MagicMock()
+
+    with self.assertRaises(KeyboardInterrupt):
+      tracker.run()
+    self.assertEqual(tracker.tick.call_count, 3)
+    mock_datetime.now.assert_called_once()
+    mock_sleep.assert_called_with(1.0)
+
+  @patch('plug_tracker.time.monotonic')
+  @patch('plug_tracker.time.sleep')
+  @patch('plug_tracker.datetime')
+  @patch('plug_tracker.SmartPlugClient')
+  def test_run_rechecks_schedule_every_minute(
+      self, mock_client_cls, mock_datetime, mock_sleep, mock_monotonic):
+    mock_client_cls.return_value.sock = None
+    # Window ends hours from now, but the wall clock is still re-read.
+    mock_datetime.now.return_value = datetime(2023, 1, 1, 9, 0, 0)
+    clock = [0.0]
+    mock_monotonic.side_effect = lambda: clock[0]
+    def sleep(seconds):
+      if clock[0] >= 150:
+        raise KeyboardInterrupt
+      clock[0] += seconds
+    mock_sleep.side_effect = sleep
+    scheduler = plug_tracker.Scheduler([(time(8, 0), time(10, 0))])
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', scheduler)
+    self.addCleanup(tracker.close)
+    tracker.tick = MagicMock()
+
+    with self.assertRaises(KeyboardInterrupt):
+      tracker.run()
+    # Checked at 0, 60 and 120 seconds.
+    self.assertEqual(mock_datetime.now.call_count, 3)
+
+  @patch('plug_tracker.time.sleep')
+  @patch('plug_tracker.datetime')
+  @patch('plug_tracker.SmartPlugClient')
+  def test_run_inactive_sleep_is_capped(
+      self, mock_client_cls, mock_datetime, mock_sleep):
+    mock_client_cls.return_value.sock = None
+    # Next window starts in 20 hours.
+    mock_datetime.now.return_value = datetime(2023, 1, 1, 12, 0, 0)
+    mock_sleep.side_effect = [None, KeyboardInterrupt]
+    scheduler = plug_tracker.Scheduler([(time(8, 0), time(10, 0))])
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', scheduler)
+    self.addCleanup(tracker.close)
+
+    with self.assertRaises(KeyboardInterrupt):
+      tracker.run()
+    mock_sleep.assert_called_with(plug_tracker.SCHEDULE_CHECK_SECONDS)
+    self.assertEqual(mock_datetime.now.call_count, 2)
+
+  def test_wait_drops_closed_leader_connection(self):
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', MagicMock())
+    self.addCleanup(tracker.close)
+    local, remote = socket.socketpair()
+    self.addCleanup(remote.close)
+    tracker.leader_client._sock = local
+
+    # Nothing to read: waits out the timeout and keeps the connection.
+    tracker._wait(0.01)
+    self.assertIs(tracker.leader_client.sock, local)
+
+    # The plug closed the connection: drops it but still waits it out.
+    remote.close()
+    start = plug_tracker.time.monotonic()
+    tracker._wait(0.2)
+    self.assertGreaterEqual(plug_tracker.time.monotonic() - start, 0.2)
+    self.assertIsNone(tracker.leader_client.sock)
+
+  def test_close(self):
+    tracker = plug_tracker.PlugTracker('1.1.1.1', '2.2.2.2', MagicMock())
+    local, remote = socket.socketpair()
+    self.addCleanup(remote.close)
+    tracker.leader_client._sock = local
+    tracker._wait(0)
+
+    tracker.close()
+    self.assertIsNone(tracker.leader_client.sock)
+    self.assertEqual(local.fileno(), -1)
+    # A closed selector has no key map.
+    self.assertIsNone(tracker._selector.get_map())
 
   def test_parse_range(self):
     # Test the static parsing method
@@ -109,5 +459,15 @@ class TestPlugTracker(unittest.TestCase):
     self.assertEqual(start, time(8, 0))
     self.assertEqual(end, time(10, 0))
 
+    start, end = parse_time_range(' 8:30 - 22:05 ')
+    self.assertEqual(start, time(8, 30))
+    self.assertEqual(end, time(22, 5))
+
+  def test_parse_range_invalid(self):
+    from plug_tracker import parse_time_range
+    for arg in ('08:00', '08:00-25:00', '08:60-10:00', '8am-10am', ''):
+      with self.assertRaises(argparse.ArgumentTypeError, msg=arg):
+        parse_time_range(arg)
+
 if __name__ == '__main__':
   unittest.main()
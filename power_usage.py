@@ -2,34 +2,22 @@
 # Copied and modified from https://github.com/softScheck/tplink-smartplug
 
 import argparse
-import json
+import importlib.util
 import logging
+import os
 import socket
 import sys
 import time
-from struct import pack
 
-sys.path.append('/opt/repos/mypylib')
-from mypylib import setup_logging, write_graphite_entries
+MYPYLIB_PATH = '/opt/repos/mypylib'
 
+if (importlib.util.find_spec('mypylib') is None
+    and os.path.isdir(MYPYLIB_PATH)):
+  sys.path.append(MYPYLIB_PATH)
+from mypylib import setup_logging, write_graphite_entries
 
-def encrypt(string):
-  key = 171
-  result = pack('>I', len(string))
-  for i in string:
-    a = key ^ ord(i)
-    key = a
-    result += bytes([a])
-  return result
+from kasa_proto import SMARTPLUG_PORT, decrypt, encrypt, json_loads
 
-def decrypt(string):
-  key = 171
-  result = ''
-  for i in string:
-    a = key ^ i
-    key = i
-    result += chr(a)
-  return result
 
 def setup_socket(ip):
   while True:
@@ -48,13 +36,12 @@ def setup_socket(ip):
 def query_smartplug(sock):
   sock.send(COMMAND)
   str_data = sock.recv(2048)
-  data = json.loads(decrypt(str_data[4:]))
+  data = json_loads(decrypt(str_data[4:]))
   return data['emeter']['get_realtime']
 
 setup_logging('/var/log/cron/power_usage.log')
 # https://github.com/softScheck/tplink-smartplug/blob/master/tplink-smarthome-commands.txt
 COMMAND = encrypt('{"emeter":{"get_realtime":{}}}')
-SMARTPLUG_PORT = 9999
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-s', '--smartplug', required=True,
@@ -73,6 +60,6 @@ while True:
   data = []
   for k,v in emeter.items():
     data.append(f'smartplug_power.computer.{k} {v} -1.')
-  logging.info(data)
+  logging.debug('%s', data)
   write_graphite_entries(data)
   time.sleep(1)